@@ -11,6 +11,10 @@ mkdir work
 mkdir work/ntsc
 mkdir work/pal
 
+# Check the NumPy routines in the modification script, which are only used for
+# binaries much larger than gma6 (this is skipped if NumPy is not installed)
+$python src/elite-modify.py --check || exit 1
+
 # Get the current date for the build filename
 CURRENTDATE=`date +%Y-%m-%d`
 
@@ -33,8 +37,9 @@ $beebasm -i ../../src/elite-flicker-free.asm -v > compile.txt
 # Assemble the additional code required for the Universe Editor
 $beebasm -i ../../src/elite-universe-editor-c64.asm -v > compile.txt
 
-# Modify the main game code
-$python ../../src/elite-modify.py ntsc
+# Modify the main game code (saving the intermediate files so they can be
+# checked against the reference binaries)
+$python ../../src/elite-modify.py ntsc --debug
 
 # Rebuild the game disk
 $c1541 \
@@ -70,8 +75,9 @@ $beebasm -i ../../src/elite-flicker-free.asm -v >> compile.txt
 # Assemble the additional code required for the Universe Editor
 $beebasm -i ../../src/elite-universe-editor-c64.asm -v > compile.txt
 
-# Modify the main game code
-$python ../../src/elite-modify.py pal
+# Modify the main game code (saving the intermediate files so they can be
+# checked against the reference binaries)
+$python ../../src/elite-modify.py pal --debug
 
 # Rebuild the game disk
 $c1541 \
@@ -26,7 +26,7 @@
 # ******************************************************************************
 
 from __future__ import print_function
-import os
+from pathlib import Path
 
 
 # Convert a C64 address into the corresponding offset within the gma6 file
@@ -38,12 +38,10 @@ def get_offset(addr):
 # Insert a binary file into the game code, overwriting what's there
 
 def insert_binary_file(data_block, addr, filename):
-    file = open(filename, "rb")
-    file_size = os.path.getsize(filename)
+    insert = Path(filename).read_bytes()
     insert_from = get_offset(addr)
-    insert_to = insert_from + file_size
-    data_block[insert_from:insert_to] = file.read()
-    file.close()
+    insert_to = insert_from + len(insert)
+    data_block[insert_from:insert_to] = insert
     print("[ Modify  ] insert file {} at 0x{:02X}".format(filename, addr))
 
 
@@ -254,8 +252,8 @@ insert_bytes(data_block, 0x9FD9 + 0x900, [
 ])
 
 lda_sta_block = get_offset(0x9FDD + 0x900)
-for n in range(lda_sta_block, lda_sta_block + 4 * 5):
-    data_block[n] = data_block[n + 4]
+data_block[lda_sta_block:lda_sta_block + 4 * 5] = \
+    data_block[lda_sta_block + 4:lda_sta_block + 4 + 4 * 5]
 
 insert_bytes(data_block, 0x9FF1 + 0x900, [
     0xC8,                                   # INY
@@ -19,7 +19,9 @@
 #   * Modify the gma1 file to remove disk protection
 #
 # Run this script by changing directory to the folder containing the disk files
-# and running the script with "python elite-modify.py"
+# and running the script with "python elite-modify.py", optionally followed by
+# the platform ("pal" or "ntsc", default "pal") and "--debug" to also save the
+# intermediate gma6.decrypted and gma6.modified files
 #
 # This modification script works with the following disk images from the
 # Commodore 64 Preservation Project:
@@ -34,57 +36,173 @@
 # ******************************************************************************
 
 from __future__ import print_function
+import argparse
+import mmap
 import os
+import shutil
 import sys
+from functools import lru_cache
+from pathlib import Path
 
 
-# Convert a C64 address into the corresponding offset within the gma6 file
+# Return the NumPy module if it is installed and the block to be processed is at
+# least numpy_threshold bytes long, or None otherwise, in which case we use the
+# pure Python routines instead (importing NumPy takes longer than the pure
+# Python routines take to process gma6, so this only loads NumPy when it will
+# pay for itself)
 
-def get_offset(addr):
-    return addr - load_address
+def import_numpy(size):
+    if size < numpy_threshold:
+        return None
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
 
 
-# Insert a binary file into the game code, overwriting what's there
+# Read a binary file, caching the contents so that a caller that runs build()
+# more than once in the same session only reads each of the extra routines from
+# disk once (build.sh runs one build per process, so this only helps other
+# callers). The cache is keyed on the current folder and the filename, so builds
+# in different folders get their own files, but a file that is rebuilt during
+# the session is not read again unless read_cached_file.cache_clear() is called
 
-def insert_binary_file(data_block, addr, filename):
-    file = open(filename, "rb")
-    file_size = os.path.getsize(filename)
-    insert_from = get_offset(addr)
-    insert_to = insert_from + file_size
-    data_block[insert_from:insert_to] = file.read()
-    file.close()
+def read_binary_file(filename):
+    return read_cached_file(os.getcwd(), filename)
+
+
+@lru_cache(maxsize=16)
+def read_cached_file(folder, filename):
+    return Path(folder, filename).read_bytes()
+
+
+# Add a binary file to the list of patches, to overwrite what's there
+
+def insert_binary_file(patches, addr, filename):
+    patches.append((addr, read_binary_file(filename)))
     print("[ Modify  ] insert file {} at 0x{:02X}".format(filename, addr))
 
 
-# Insert an array of bytes into the game code, overwriting what's there
+# Add a bytes object to the list of patches, to overwrite what's there
 
-def insert_bytes(data_block, addr, insert):
-    insert_from = get_offset(addr)
-    insert_to = insert_from + len(insert)
-    data_block[insert_from:insert_to] = insert
+def insert_bytes(patches, addr, insert):
+    patches.append((addr, insert))
     print("[ Modify  ] insert {} bytes at 0x{:02X}".format(len(insert), addr))
 
 
-# Insert a block of NOPs into the game code, overwriting what's there
+# Add a block of NOPs to the list of patches, to overwrite what's there
 
-def insert_nops(data_block, addr, count):
-    insert = [0xEA] * count
-    insert_bytes(data_block, addr, insert)
+def insert_nops(patches, addr, count):
+    insert = b"\xEA" * count
+    insert_bytes(patches, addr, insert)
     print("[ Modify  ] insert {} NOPs at 0x{:02X}".format(count, addr))
 
 
-# Fetch the platform (NTSC or PAL) from the command line arguments
-
-if len(sys.argv) >= 2:
-    platform = sys.argv[1]
-else:
-    platform = "pal"
-
-# Print a progess message
+# Apply a list of patches to the game code in one pass, in the order they were
+# added
+
+def apply_patches(data_block, patches):
+    for addr, insert in patches:
+        insert_from = addr - load_address
+        insert_to = insert_from + len(insert)
+        data_block[insert_from:insert_to] = insert
+    print("[ Modify  ] apply {} patches".format(len(patches)))
+
+
+# Calculate the reversed cumulative sum of a NumPy array (so each element is
+# the sum of itself and every element after it). Large arrays are split into
+# one chunk per CPU (or per worker, if workers is given), which are summed in
+# parallel (NumPy releases the GIL while it does this) and then stitched
+# together by adding the running total of the preceding chunks to each one
+
+def reverse_cumsum(values, workers=None):
+    import numpy as np
+    values = values[::-1]
+    workers = min(workers or os.cpu_count() or 1, len(values))
+    if len(values) < parallel_threshold or workers == 1:
+        return np.cumsum(values)[::-1]
+    from concurrent.futures import ThreadPoolExecutor
+    chunks = np.array_split(values, workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        sums = list(executor.map(np.cumsum, chunks))
+    offsets = np.cumsum([0] + [chunk_sum[-1] for chunk_sum in sums[:-1]])
+    lengths = [len(chunk) for chunk in chunks]
+    return (np.concatenate(sums) + np.repeat(offsets, lengths))[::-1]
+
+
+# Compile the source code for a function and return the function with the
+# given name, so we can generate loops with their constants built in
+
+def compile_kernel(name, source):
+    namespace = {}
+    exec(compile(source, "<{}>".format(name), "exec"), namespace)
+    return namespace[name]
+
+
+# Decrypt the game code between two C64 addresses (inclusive)
+
+def decrypt(data_block, addr_from, addr_to, seed):
+    decrypt_from = addr_from - load_address
+    decrypt_to = addr_to - load_address + 1
+    np = import_numpy(decrypt_to - decrypt_from)
+    if np is not None:
+        # Each decrypted byte is the encrypted byte minus the decrypted byte
+        # that follows it, so if we unroll this, each decrypted byte is an
+        # alternating sum of all the encrypted bytes from that point to the
+        # end, followed by the seed (which is added or subtracted, depending on
+        # its distance from the end). We can therefore decrypt everything in
+        # one go by flipping the sign of every other byte and taking a reversed
+        # cumulative sum
+        buf = np.frombuffer(data_block, dtype=np.uint8,
+                            count=decrypt_to - decrypt_from,
+                            offset=decrypt_from).astype(np.int64)
+        signs = np.where(np.arange(len(buf)) & 1, -1, 1)
+        seed_term = seed if len(buf) % 2 == 0 else -seed
+        decoded = signs * (reverse_cumsum(signs * buf) + seed_term)
+        data_block[decrypt_from:decrypt_to] = (decoded & 0xFF).astype(np.uint8).tobytes()
+    else:
+        # Otherwise we compile a loop with the offsets and seed built in, and
+        # run it on the game code
+        descramble = compile_kernel("descramble", """
+def descramble(code):
+    updated_seed = {seed}
+    for n in range({start}, {stop}, -1):
+        new = (code[n] - updated_seed) & 0xFF
+        code[n] = new
+        updated_seed = new
+""".format(seed=seed, start=decrypt_to - 1, stop=decrypt_from - 1))
+        descramble(data_block)
+
+
+# Encrypt the game code between two C64 addresses (inclusive)
+
+def encrypt(data_block, addr_from, addr_to, seed):
+    encrypt_from = addr_from - load_address
+    encrypt_to = addr_to - load_address + 1
+    np = import_numpy(encrypt_to - encrypt_from)
+    if np is not None:
+        # Each encrypted byte is the sum of the original byte and the original
+        # byte that follows it (or the seed, for the last byte), so we can add
+        # the whole block to a copy of itself that's been shifted down by one
+        # byte
+        region = np.frombuffer(data_block, dtype=np.uint8,
+                               count=encrypt_to - encrypt_from,
+                               offset=encrypt_from)
+        encoded = region.astype(np.uint16)
+        encoded[:-1] += region[1:]
+        encoded[-1] += seed
+        data_block[encrypt_from:encrypt_to] = (encoded & 0xFF).astype(np.uint8).tobytes()
+    else:
+        scramble = compile_kernel("scramble", """
+def scramble(code):
+    for n in range({start}, {last}):
+        code[n] = (code[n] + code[n + 1]) & 0xFF
+
+    code[{last}] = (code[{last}] + {seed}) & 0xFF
+""".format(seed=seed, start=encrypt_from, last=encrypt_to - 1))
+        scramble(data_block)
 
-print()
-print("Modifying Commodore 64 Elite")
-print("Platform: {}".format(platform.upper()))
 
 # Configuration variables for gma6
 
@@ -93,401 +211,535 @@ seed = 0x49
 scramble_from = 0x6A00
 scramble_to = 0x6A00 + 0x62D6
 
-# Set up an array to hold the game binary, so we can modify it
-
-data_block = bytearray()
-
-# Load the main code file into data_block
-
-elite_file = open("gma6", "rb")
-data_block.extend(elite_file.read())
-elite_file.close()
-
-print()
-print("[ Read    ] gma6")
-
-# Decrypt the main code file
-
-updated_seed = seed
-
-for n in range(scramble_to, scramble_from - 1, -1):
-    new = (data_block[n - load_address] - updated_seed) % 256
-    data_block[n - load_address] = new
-    updated_seed = new
-
-print("[ Decrypt ] gma6")
-
-# Write an output file containing the decrypted but unmodified game code, which
-# we can use for debugging
-
-output_file = open("gma6.decrypted", "wb")
-output_file.write(data_block)
-output_file.close()
-
-print("[ Save    ] gma6.decrypted")
-
-# Set the addresses for the extra routines (LSPUT, PATCH1, PATCH2) that we will
-# append to the end of the main game code (where there is a bit of free space)
-
-lsput = 0xCCE0
-patch1 = 0xCD1E
-patch2 = 0xCD35
-
-# We now modify the code to implement flicker-free ship drawing. The code
-# changes are described here, which can be read alongside the following:
-#
-# https://elite.bbcelite.com/deep_dives/backporting_the_flicker-free_algorithm.html
-#
-# The addresses in the following are from when the game binary is loaded into
-# memory. They were calculated by analysing a memory dump of the running game,
-# searching for patterns in the bytes to match them with the corrsponding code
-# from the BBC Micro version (which is very similar, if you ignore any different
-# addresses).
-
-# SHPPT
-#
-# We start with the new version of SHPPT, which we have already assembled in
-# BeebAsm and saved as the binary file shppt.bin, so we simply drop this over
-# the top of the existing routine (which is slightly longer, so there is room).
-
-insert_binary_file(data_block, 0x9932, "shppt.bin")
-
-# LL9 (Part 1)
-#
-# This is the modification just after LL9. We insert the extra code with a call
-# to the new PATCH1 routine, which implements the original instructions before
-# moving on to the new code.
-#
-# From: LDA #31
-#       STA XX4
-#
-# To:   JSR PATCH1
-#       NOP
-
-insert_bytes(data_block, 0x9A8A, [
-    0x20, patch1 % 256, patch1 // 256   # JSR PATCH1
-])
-insert_nops(data_block, 0x9A8D, 1)
-
-# LL9 (Part 9)
-#
-# This is the modification at EE31.
-#
-# From: LDA #%00001000
-#       BIT XX1+31
-#       BEQ LL74
-#       JSR LL155
-#
-# To:   LDY #9
-#       LDA (XX0),Y
-#       STA XX20
-#       NOP
-#       NOP
-#       NOP
-
-insert_bytes(data_block, 0x9F2A, [
-    0xA0, 0x09,                         # LDY #9
-    0xB1, 0x57,                         # LDA (XX0),Y
-    0x85, 0xAE                          # STA XX20
-])
-insert_nops(data_block, 0x9F30, 3)
-
-# LL9 (Part 9)
-#
-# This is the modification just after LL74.
-#
-# From: LDY #9
-#       LDA (XX0),Y
-#       STA XX20
-#       LDY #0
-#       STY U
-#       STY XX17
-#       INC U
-#
-# To:   LDY #0
-#       STY XX17
-#       NOP x10
-
-insert_bytes(data_block, 0x9F39, [
-    0xA0, 0x00,                         # LDY #0
-    0x84, 0x9F                          # STY XX17
-])
-insert_nops(data_block, 0x9F3D, 10)
-
-# LL9 (Part 9)
-#
-# This is the modification at the end of the routine.
-#
-# From: LDA XX15
-#       STA (XX19),Y
-#       INY
-#       LDA XX15+1
-#       STA (XX19),Y
-#       INY
-#       LDA XX15+2
-#       STA (XX19),Y
-#       INY
-#       LDA XX15+3
-#       STA (XX19),Y
-#       INY
-#       STY U
-#
-# To:   JSR LSPUT
-#       NOP x21
-
-insert_bytes(data_block, 0x9F87, [
-    0x20, lsput % 256, lsput // 256     # JSR LSPUT
-])
-insert_nops(data_block, 0x9F8A, 21)
-
-# LL9 (Part 10)
-#
-# This is the modification around LL75.
-#
-# From: STA T1
-#       LDY XX17
-#
-# To:   STA CNT
-#       LDY #0
-
-insert_bytes(data_block, 0x9FB4, [
-    0x85, 0x30,                         # STA CNT
-    0xA0, 0x00                          # LDY #0
-])
-
-# LL9 (Part 10)
-#
-# This is the second INY after LL75.
-#
-# From: INY
-#
-# To:   NOP
-
-insert_nops(data_block, 0x9FC1, 1)
-
-# LL9 (Part 10)
-#
-# These are the two modifications at LL79.
-#
-# From: LDA (V),Y
-#       TAX
-#       INY
-#       LDA (V),Y
-#       STA Q
-#       ... four lots of unchanged LDA/STA, 5 bytes each ...
-#       LDX Q
-#
-# To:   INY
-#       LDA (V),Y
-#       TAX
-#       ... shuffle the LDA/STA block down by 4 bytes ...
-#       INY
-#       LDA (V),Y
-#       TAX
-#       NOP
-#       NOP
-
-insert_bytes(data_block, 0x9FD9, [
-    0xC8,                               # INY
-    0xB1, 0x5B,                         # LDA (V),Y
-    0xAA                                # TAX
-])
-
-lda_sta_block = get_offset(0x9FDD)
-for n in range(lda_sta_block, lda_sta_block + 4 * 5):
-    data_block[n] = data_block[n + 4]
-
-insert_bytes(data_block, 0x9FF1, [
-    0xC8,                               # INY
-    0xB1, 0x5B,                         # LDA (V),Y
-    0xAA                                # TAX
-])
-insert_nops(data_block, 0x9FF5, 2)
-
-# LL9 (Part 10)
-#
-# This is the modification at the end of the routine. The C64 version has an
-# extra JMP LL80 instruction at this point that we can modify to jump to a
-# new routine PATCH2, which lets us insert the extra JSR LSPUT without taking
-# up any more bytes.
-#
-# From: JMP LL80
-#
-# To:   JMP PATCH2
-
-insert_bytes(data_block, 0xA010, [
-    0x4C, patch2 % 256, patch2 // 256   # JMP PATCH2
-])
-
-# LL9 (Part 11)
-#
-# This is the modification at LL80.
-#
-# We blank out the .LL80 section with 28 NOPs
-
-insert_nops(data_block, 0xA13F, 28)
-
-# LL9 (Part 11)
-#
-# We have already assembled the modified part 11 in BeebAsm and saved it as
-# the binary file ll78.bin, so now we drop this over the top of the existing
-# routine (which is exactly the same size).
-
-insert_binary_file(data_block, 0xA15B, "ll78.bin")
-
-# LL9 (Part 12)
-#
-# We have already assembled the modified part 11 in BeebAsm and saved it as
-# the binary file ll115.bin, so now we drop this over the top of the existing
-# routine (which is slightly longer, so there is room).
-
-insert_binary_file(data_block, 0xA178, "ll155.bin")
-
-# We now append the three extra routines required by the modifications to the
-# end of the main binary (where there is enough free space for them):
-#
-#   LSPUT
-#   PATCH1
-#   PATCH2
-#
-# We have already assembled these in BeebAsm and saved them as the binary file
-# extra.bin, so we simply append this file to the end.
-
-elite_file = open("extra.bin", "rb")
-data_block.extend(elite_file.read())
-elite_file.close()
-
-print("[ Modify  ] append file extra.bin")
-
-# We now add the Universe Editor, which lives in the block of memory that's
-# normally taken up by the title and docking music
-
-# Set the addresses for the patch routines that we will inject into the main
-# game code to call the Universe Editor
-
-patch1 = 0xB72D
-patch2 = 0xB738
-patch3 = 0xB745
-
-# The first step is to disable the music, which we can do easily by simply
-# returning from the music routine at $920D, so that the music never gets
-# played.
-
-insert_bytes(data_block, 0x920D, [
-    0x60                                # RTS
-])
-
-# BR1
-#
-# Next we patch the BR1 routine to detect the "0" key press to start the
-# Universe Editor. We change the call to TITLE to jump to the PATCH1 routine,
-# which implements the original instructions before checking for the Universe
-# Editor key press.
-#
-# From: JSR TITLE
-#
-# To:   JSR PATCH1
-
-insert_bytes(data_block, 0x8899, [
-    0x20, patch1 % 256, patch1 // 256     # JSR PATCH1
-])
-
-# TITLE
-#
-# This is the modification to TITLE to display the Universe Editor subtitle.
-#
-# From: LDA #6
-#       JSR DOXC
-#       LDA PATG
-#       BEQ awe
-#       LDA #13
-#       JSR DETOK
-#
-# To:   JSR PATCH2
-#       NOP x12
-
-insert_bytes(data_block, 0x8969, [
-    0x20, patch2 % 256, patch2 // 256     # JSR PATCH2
-])
-insert_nops(data_block, 0x896C, 12)
-
-# BEGIN
-#
-# Next, we patch the game entry point so the game defaults to disk rather than
-# tape, which we can do by changing the option relevant byte from 0 to &FF.
-
-# From: JSR JAMESON
-#
-# To:   JSR PATCH3
-
-insert_bytes(data_block, 0x8879, [
-    0x20, patch3 % 256, patch3 // 256     # JSR PATCH3
-])
-
-# UniverseEditor
-#
-# We have already assembled the Universe Editor in BeebAsm and saved it as
-# the binary file editor.bin, so now we drop this over the top of the music
-# data at $B72D.
+# The size above which reverse_cumsum splits the work across threads (gma6 is
+# well below this, so it is only used for much larger binaries, though it can
+# be checked by running this script with --check)
 
-insert_binary_file(data_block, 0xB72D, "editor.bin")
+parallel_threshold = 0x100000
 
-# All the modifications are done, so write the output file for gma6.modified,
-# which we can use for debugging
+# The size above which the scramble and patch routines use NumPy, if it is
+# installed (gma6 is well below this, so by default it is processed in pure
+# Python)
 
-output_file = open("gma6.modified", "wb")
-output_file.write(data_block)
-output_file.close()
+numpy_threshold = 0x100000
 
-print("[ Save    ] gma6.modified")
 
-# Encrypt the main code file
+# Modify the game files for the given platform ("pal" or "ntsc"), saving the
+# intermediate gma6 files as well if debug is set
 
-for n in range(scramble_from, scramble_to):
-    data_block[n - load_address] = (data_block[n - load_address] + data_block[n + 1 - load_address]) % 256
+def build(platform, debug=False):
+    # Print a progess message
+
+    print()
+    print("Modifying Commodore 64 Elite")
+    print("Platform: {}".format(platform.upper()))
+
+    # Set up an array to hold the game binary, so we can modify it
+
+    data_block = bytearray()
+
+    # Load the main code file into data_block
+
+    data_block.extend(Path("gma6").read_bytes())
+
+    print()
+    print("[ Read    ] gma6")
+
+    # Decrypt the main code file
+
+    decrypt(data_block, scramble_from, scramble_to, seed)
+
+    print("[ Decrypt ] gma6")
+
+    # If this is a debug run, write an output file containing the decrypted but
+    # unmodified game code
+
+    if debug:
+        Path("gma6.decrypted").write_bytes(data_block)
+        print("[ Save    ] gma6.decrypted")
+
+    # Set up a list to hold the patches as we build them up, so we can apply
+    # them to the game code in one go once we are done
+
+    patches = []
+
+    # Set the addresses for the extra routines (LSPUT, PATCH1, PATCH2) that we
+    # will append to the end of the main game code (where there is a bit of free
+    # space)
+
+    lsput = 0xCCE0
+    patch1 = 0xCD1E
+    patch2 = 0xCD35
+
+    # We now modify the code to implement flicker-free ship drawing. The code
+    # changes are described here, which can be read alongside the following:
+    #
+    # https://elite.bbcelite.com/deep_dives/backporting_the_flicker-free_algorithm.html
+    #
+    # The addresses in the following are from when the game binary is loaded
+    # into memory. They were calculated by analysing a memory dump of the
+    # running game, searching for patterns in the bytes to match them with the
+    # corrsponding code from the BBC Micro version (which is very similar, if
+    # you ignore any different addresses).
+
+    # SHPPT
+    #
+    # We start with the new version of SHPPT, which we have already assembled in
+    # BeebAsm and saved as the binary file shppt.bin, so we simply drop this
+    # over the top of the existing routine (which is slightly longer, so there
+    # is room).
+
+    insert_binary_file(patches, 0x9932, "shppt.bin")
+
+    # LL9 (Part 1)
+    #
+    # This is the modification just after LL9. We insert the extra code with a
+    # call to the new PATCH1 routine, which implements the original instructions
+    # before moving on to the new code.
+    #
+    # From: LDA #31
+    #       STA XX4
+    #
+    # To:   JSR PATCH1
+    #       NOP
+
+    insert_bytes(patches, 0x9A8A, bytes((
+        0x20, patch1 & 0xFF, patch1 >> 8    # JSR PATCH1
+    )))
+    insert_nops(patches, 0x9A8D, 1)
+
+    # LL9 (Part 9)
+    #
+    # This is the modification at EE31.
+    #
+    # From: LDA #%00001000
+    #       BIT XX1+31
+    #       BEQ LL74
+    #       JSR LL155
+    #
+    # To:   LDY #9
+    #       LDA (XX0),Y
+    #       STA XX20
+    #       NOP
+    #       NOP
+    #       NOP
+
+    insert_bytes(patches, 0x9F2A, bytes((
+        0xA0, 0x09,                         # LDY #9
+        0xB1, 0x57,                         # LDA (XX0),Y
+        0x85, 0xAE                          # STA XX20
+    )))
+    insert_nops(patches, 0x9F30, 3)
+
+    # LL9 (Part 9)
+    #
+    # This is the modification just after LL74.
+    #
+    # From: LDY #9
+    #       LDA (XX0),Y
+    #       STA XX20
+    #       LDY #0
+    #       STY U
+    #       STY XX17
+    #       INC U
+    #
+    # To:   LDY #0
+    #       STY XX17
+    #       NOP x10
+
+    insert_bytes(patches, 0x9F39, bytes((
+        0xA0, 0x00,                         # LDY #0
+        0x84, 0x9F                          # STY XX17
+    )))
+    insert_nops(patches, 0x9F3D, 10)
+
+    # LL9 (Part 9)
+    #
+    # This is the modification at the end of the routine.
+    #
+    # From: LDA XX15
+    #       STA (XX19),Y
+    #       INY
+    #       LDA XX15+1
+    #       STA (XX19),Y
+    #       INY
+    #       LDA XX15+2
+    #       STA (XX19),Y
+    #       INY
+    #       LDA XX15+3
+    #       STA (XX19),Y
+    #       INY
+    #       STY U
+    #
+    # To:   JSR LSPUT
+    #       NOP x21
+
+    insert_bytes(patches, 0x9F87, bytes((
+        0x20, lsput & 0xFF, lsput >> 8      # JSR LSPUT
+    )))
+    insert_nops(patches, 0x9F8A, 21)
+
+    # LL9 (Part 10)
+    #
+    # This is the modification around LL75.
+    #
+    # From: STA T1
+    #       LDY XX17
+    #
+    # To:   STA CNT
+    #       LDY #0
+
+    insert_bytes(patches, 0x9FB4, bytes((
+        0x85, 0x30,                         # STA CNT
+        0xA0, 0x00                          # LDY #0
+    )))
+
+    # LL9 (Part 10)
+    #
+    # This is the second INY after LL75.
+    #
+    # From: INY
+    #
+    # To:   NOP
+
+    insert_nops(patches, 0x9FC1, 1)
+
+    # LL9 (Part 10)
+    #
+    # These are the two modifications at LL79.
+    #
+    # From: LDA (V),Y
+    #       TAX
+    #       INY
+    #       LDA (V),Y
+    #       STA Q
+    #       ... four lots of unchanged LDA/STA, 5 bytes each ...
+    #       LDX Q
+    #
+    # To:   INY
+    #       LDA (V),Y
+    #       TAX
+    #       ... shuffle the LDA/STA block down by 4 bytes ...
+    #       INY
+    #       LDA (V),Y
+    #       TAX
+    #       NOP
+    #       NOP
+
+    insert_bytes(patches, 0x9FD9, bytes((
+        0xC8,                               # INY
+        0xB1, 0x5B,                         # LDA (V),Y
+        0xAA                                # TAX
+    )))
+
+    # The shuffle is done directly on the game code rather than being added to
+    # the list of patches, which is fine as none of the patches overlap these bytes
+
+    lda_sta_block = 0x9FDD - load_address
+    data_block[lda_sta_block:lda_sta_block + 4 * 5] = \
+        data_block[lda_sta_block + 4:lda_sta_block + 4 + 4 * 5]
+
+    insert_bytes(patches, 0x9FF1, bytes((
+        0xC8,                               # INY
+        0xB1, 0x5B,                         # LDA (V),Y
+        0xAA                                # TAX
+    )))
+    insert_nops(patches, 0x9FF5, 2)
+
+    # LL9 (Part 10)
+    #
+    # This is the modification at the end of the routine. The C64 version has an
+    # extra JMP LL80 instruction at this point that we can modify to jump to a
+    # new routine PATCH2, which lets us insert the extra JSR LSPUT without
+    # taking up any more bytes.
+    #
+    # From: JMP LL80
+    #
+    # To:   JMP PATCH2
+
+    insert_bytes(patches, 0xA010, bytes((
+        0x4C, patch2 & 0xFF, patch2 >> 8    # JMP PATCH2
+    )))
+
+    # LL9 (Part 11)
+    #
+    # This is the modification at LL80.
+    #
+    # We blank out the .LL80 section with 28 NOPs
+
+    insert_nops(patches, 0xA13F, 28)
+
+    # LL9 (Part 11)
+    #
+    # We have already assembled the modified part 11 in BeebAsm and saved it as
+    # the binary file ll78.bin, so now we drop this over the top of the existing
+    # routine (which is exactly the same size).
+
+    insert_binary_file(patches, 0xA15B, "ll78.bin")
+
+    # LL9 (Part 12)
+    #
+    # We have already assembled the modified part 11 in BeebAsm and saved it as
+    # the binary file ll115.bin, so now we drop this over the top of the
+    # existing routine (which is slightly longer, so there is room).
+
+    insert_binary_file(patches, 0xA178, "ll155.bin")
+
+    # We now append the three extra routines required by the modifications to
+    # the end of the main binary (where there is enough free space for them):
+    #
+    #   LSPUT
+    #   PATCH1
+    #   PATCH2
+    #
+    # We have already assembled these in BeebAsm and saved them as the binary
+    # file extra.bin, so we simply append this file to the end.
+
+    data_block.extend(read_binary_file("extra.bin"))
+
+    print("[ Modify  ] append file extra.bin")
+
+    # We now add the Universe Editor, which lives in the block of memory that's
+    # normally taken up by the title and docking music
+
+    # Set the addresses for the patch routines that we will inject into the main
+    # game code to call the Universe Editor
+
+    patch1 = 0xB72D
+    patch2 = 0xB738
+    patch3 = 0xB745
+
+    # The first step is to disable the music, which we can do easily by simply
+    # returning from the music routine at $920D, so that the music never gets
+    # played.
+
+    insert_bytes(patches, 0x920D, bytes((
+        0x60,                               # RTS
+    )))
+
+    # BR1
+    #
+    # Next we patch the BR1 routine to detect the "0" key press to start the
+    # Universe Editor. We change the call to TITLE to jump to the PATCH1
+    # routine, which implements the original instructions before checking for
+    # the Universe Editor key press.
+    #
+    # From: JSR TITLE
+    #
+    # To:   JSR PATCH1
+
+    insert_bytes(patches, 0x8899, bytes((
+        0x20, patch1 & 0xFF, patch1 >> 8    # JSR PATCH1
+    )))
+
+    # TITLE
+    #
+    # This is the modification to TITLE to display the Universe Editor subtitle.
+    #
+    # From: LDA #6
+    #       JSR DOXC
+    #       LDA PATG
+    #       BEQ awe
+    #       LDA #13
+    #       JSR DETOK
+    #
+    # To:   JSR PATCH2
+    #       NOP x12
+
+    insert_bytes(patches, 0x8969, bytes((
+        0x20, patch2 & 0xFF, patch2 >> 8    # JSR PATCH2
+    )))
+    insert_nops(patches, 0x896C, 12)
+
+    # BEGIN
+    #
+    # Next, we patch the game entry point so the game defaults to disk rather
+    # than tape, which we can do by changing the option relevant byte from 0 to
+    # &FF.
 
-data_block[scramble_to - load_address] = (data_block[scramble_to - load_address] + seed) % 256
+    # From: JSR JAMESON
+    #
+    # To:   JSR PATCH3
+
+    insert_bytes(patches, 0x8879, bytes((
+        0x20, patch3 & 0xFF, patch3 >> 8    # JSR PATCH3
+    )))
 
-print("[ Encrypt ] gma6.modified")
+    # UniverseEditor
+    #
+    # We have already assembled the Universe Editor in BeebAsm and saved it as
+    # the binary file editor.bin, so now we drop this over the top of the music
+    # data at $B72D.
+
+    insert_binary_file(patches, 0xB72D, "editor.bin")
+
+    # All the modifications are now in the list of patches, so apply them to
+    # the game code
+
+    apply_patches(data_block, patches)
+
+    # All the modifications are done, so if this is a debug run, write the
+    # output file for gma6.modified
+
+    if debug:
+        Path("gma6.modified").write_bytes(data_block)
+        print("[ Save    ] gma6.modified")
+
+    # Encrypt the main code file
+
+    encrypt(data_block, scramble_from, scramble_to, seed)
+
+    print("[ Encrypt ] gma6.modified")
+
+    # Write the output file for gma6.encrypted, which contains our modified game
+    # binary with the flicker-free code
+
+    Path("gma6.encrypted").write_bytes(data_block)
+
+    print("[ Save    ] gma6.encrypted")
+
+    # Finally, we need to remove the disk protection from gma1, as described
+    # here:
+    # https://www.lemon64.com/forum/viewtopic.php?t=67762&start=90
+
+    # There are only a few bytes to change, so rather than loading the whole
+    # file, we copy it to gma1.modified and memory-map the copy, so we can patch
+    # it in place and let the operating system write the changes back to disk
+
+    shutil.copyfile("gma1", "gma1.modified")
+
+    print()
+    print("[ Copy    ] gma1 to gma1.modified")
+
+    with open("gma1.modified", "r+b") as gma1_file:
+        with mmap.mmap(gma1_file.fileno(), 0) as gma1:
+            if platform == "pal":
+                # For elite[firebird_1986](pal)(v040486).g64
+                gma1[0x25] = 0xEA
+                gma1[0x26] = 0xEA
+                gma1[0x27] = 0xEA
+                gma1[0x2C] = 0xD0
+            else:
+                # For elite[firebird_1986](ntsc)(v060186)(!).g64
+                gma1[0x14] = 0xEA
+                gma1[0x16] = 0xEA
+                gma1[0x15] = 0xEA
+
+            print("[ Modify  ] gma1.modified")
+
+            gma1.flush()
+
+    print("[ Save    ] gma1.modified")
+    print()
+
+
+# Run decrypt or encrypt on a copy of a block of data, either with NumPy or with
+# the pure Python loop, and return the result
+
+def run_scramble(routine, data, use_numpy):
+    global numpy_threshold
+    saved_threshold = numpy_threshold
+    numpy_threshold = 0 if use_numpy else len(data) + 1
+    try:
+        result = bytearray(data)
+        routine(result, load_address, load_address + len(result) - 1, seed)
+    finally:
+        numpy_threshold = saved_threshold
+    return result
 
-# Write the output file for gma6.encrypted, which contains our modified game
-# binary with the flicker-free code
 
-output_file = open("gma6.encrypted", "wb")
-output_file.write(data_block)
-output_file.close()
+# Print the result of a check and return it
 
-print("[ Save    ] gma6.encrypted")
+def report_check(name, passed):
+    print("[ Check   ] {}: {}".format(name, "OK" if passed else "FAILED"))
+    return passed
 
-# Finally, we need to remove the disk protection from gma1, as described here:
-# https://www.lemon64.com/forum/viewtopic.php?t=67762&start=90
 
-data_block = bytearray()
+# Check the NumPy routines, which are only used for blocks that are much larger
+# than gma6, so they never run during a normal build. We do this by running
+# them on small blocks of random data with the thresholds forced down, and
+# comparing the results against the straightforward versions. Returns True if
+# all the checks pass, or if NumPy is not installed (in which case the NumPy
+# routines can never run)
 
-elite_file = open("gma1", "rb")
-data_block.extend(elite_file.read())
-elite_file.close()
+def check():
+    global parallel_threshold
 
-print()
-print("[ Read    ] gma1")
+    print()
+    print("Checking NumPy routines")
+    print()
 
-if platform == "pal":
-    # For elite[firebird_1986](pal)(v040486).g64
-    data_block[0x25] = 0xEA
-    data_block[0x26] = 0xEA
-    data_block[0x27] = 0xEA
-    data_block[0x2C] = 0xD0
-else:
-    # For elite[firebird_1986](ntsc)(v060186)(!).g64
-    data_block[0x14] = 0xEA
-    data_block[0x16] = 0xEA
-    data_block[0x15] = 0xEA
+    np = import_numpy(numpy_threshold)
+    if np is None:
+        print("[ Check   ] NumPy is not installed, skipping")
+        print()
+        return True
 
-print("[ Modify  ] gma1")
+    rng = np.random.default_rng(0)
+    lengths = (1, 2, 3, 63, 64, 65, 1001)
+    passed = True
 
-output_file = open("gma1.modified", "wb")
-output_file.write(data_block)
-output_file.close()
+    # Check the threaded reverse_cumsum against a single reversed cumsum, for
+    # various numbers of workers (including more workers than values)
 
-print("[ Save    ] gma1.modified")
-print()
+    saved_threshold = parallel_threshold
+    parallel_threshold = 0
+    try:
+        matches = True
+        for length in lengths:
+            values = rng.integers(-0xFF, 0x100, length)
+            expected = np.cumsum(values[::-1])[::-1]
+            for workers in (1, 2, 4, 64):
+                result = reverse_cumsum(values, workers)
+                matches = matches and np.array_equal(result, expected)
+        passed = report_check("reverse_cumsum", matches) and passed
+    finally:
+        parallel_threshold = saved_threshold
+
+    # Check that decrypt gives the same results with NumPy as it does with the
+    # pure Python loop, including a block the size of gma6
+
+    matches = True
+    for length in lengths + (scramble_to - scramble_from + 1,):
+        data = rng.integers(0, 0x100, length, dtype=np.uint8).tobytes()
+        matches = matches and (run_scramble(decrypt, data, True)
+                               == run_scramble(decrypt, data, False))
+    passed = report_check("decrypt", matches) and passed
+
+    # Check that encrypt gives the same results with NumPy as it does with the
+    # pure Python loop, and that it reverses decrypt
+
+    matches = True
+    round_trips = True
+    for length in lengths + (scramble_to - scramble_from + 1,):
+        data = rng.integers(0, 0x100, length, dtype=np.uint8).tobytes()
+        encrypted = run_scramble(encrypt, data, True)
+        matches = matches and encrypted == run_scramble(encrypt, data, False)
+        decrypted = run_scramble(decrypt, encrypted, True)
+        round_trips = round_trips and decrypted == data
+    passed = report_check("encrypt", matches) and passed
+    passed = report_check("encrypt then decrypt", round_trips) and passed
+
+    print()
+    return passed
+
+
+# Fetch the platform (NTSC or PAL) and debug flag from the command line
+# arguments, and build the game files (or, if --check is given, check the NumPy
+# routines instead)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("platform", nargs="?", default="pal")
+    parser.add_argument("--debug", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check() else 1)
+
+    build(args.platform, args.debug)
+
+
+if __name__ == "__main__":
+    main()